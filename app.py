@@ -12,9 +12,9 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 import os
-import json
-import msal  # You'll need to pip install msal
 import time
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 from teams_direct_messaging import TeamsMessenger
 
 
@@ -27,6 +27,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Upper bound on concurrent Teams webhook posts
+WEBHOOK_MAX_WORKERS = 8
+
 # Initialize session state
 if 'odoo_uid' not in st.session_state:
     st.session_state.odoo_uid = None
@@ -96,6 +99,10 @@ if 'azure_tenant_id' not in st.session_state:
     st.session_state.azure_tenant_id = ""
 if 'designer_teams_id_mapping' not in st.session_state:
     st.session_state.designer_teams_id_mapping = {}
+if 'teams_messenger' not in st.session_state:
+    st.session_state.teams_messenger = None
+if 'teams_messenger_credentials' not in st.session_state:
+    st.session_state.teams_messenger_credentials = None
 
 
 # Load Azure AD credentials from secrets if they exist
@@ -164,8 +171,7 @@ def load_employee_data():
             logger.error(f"Employee data file not found: {csv_path}")
             return None
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error loading employee data: {e}\n{error_details}")
+        logger.exception("Error loading employee data: %s", e)
         return None
     
 def update_designer_mappings_from_csv():
@@ -201,29 +207,43 @@ if st.session_state.employee_data is not None:
     update_designer_mappings_from_csv()
 
 
-def send_designer_notification(designer_name, designer_teams_id, tasks):
-    """Send a notification to a designer"""
-    
-    # Create messenger
-    messenger = TeamsMessenger(
+def get_teams_messenger():
+    """Return the TeamsMessenger for the configured Azure AD app, reused across reruns"""
+    credentials = (
         st.session_state.azure_client_id,
         st.session_state.azure_client_secret,
         st.session_state.azure_tenant_id
     )
     
+    # Rebuild only when the credentials change; otherwise keep the pooled
+    # connections and token of the existing messenger
+    if st.session_state.teams_messenger is None or st.session_state.teams_messenger_credentials != credentials:
+        if st.session_state.teams_messenger is not None:
+            st.session_state.teams_messenger.close()
+        st.session_state.teams_messenger = TeamsMessenger(*credentials)
+        st.session_state.teams_messenger_credentials = credentials
+    
+    return st.session_state.teams_messenger
+
+def build_designer_notification_message(tasks):
+    """Build the compact Teams notification text for a designer's tasks"""
     # Format a compact message for topic
     max_days_overdue = max(t.get("Days Overdue", 0) for t in tasks)
     urgency_emoji = "🔴" if max_days_overdue >= 2 else "🟠"
     
     # Create a concise but informative topic
     task_summary = f"{len(tasks)} task{'s' if len(tasks) > 1 else ''}"
-    oldest_date = min([t.get("Date", "") for t in tasks if t.get("Date")])
+    oldest_date = min(t["Date"] for t in tasks if t.get("Date"))
     
     # Format the notification topic
-    message = f"{urgency_emoji} TIMESHEET ALERT - {task_summary} missing hours (oldest: {oldest_date}) - Action required"
+    return f"{urgency_emoji} TIMESHEET ALERT - {task_summary} missing hours (oldest: {oldest_date}) - Action required"
+
+def send_designer_notification(designer_name, designer_teams_id, tasks):
+    """Send a notification to a designer"""
     
     # Send notification
-    return messenger.notify_user(designer_teams_id, message)
+    messenger = get_teams_messenger()
+    return messenger.notify_user(designer_teams_id, build_designer_notification_message(tasks))
 
 def render_teams_direct_messaging_ui():
     """Render the UI for Teams direct messaging configuration"""
@@ -265,12 +285,8 @@ def render_teams_direct_messaging_ui():
                 st.error("Please configure Azure AD credentials first")
             else:
                 try:
-                    # Create Teams messenger
-                    messenger = TeamsMessenger(
-                        st.session_state.azure_client_id,
-                        st.session_state.azure_client_secret,
-                        st.session_state.azure_tenant_id
-                    )
+                    # Get Teams messenger
+                    messenger = get_teams_messenger()
                     
                     # Test authentication
                     with st.spinner("Testing authentication..."):
@@ -370,25 +386,25 @@ def send_designer_teams_direct_messages(designers, selected_date):
     success_count = 0
     fail_count = 0
     
-    # Send direct message to each designer with missing timesheets
+    # Collect a notification for each designer with missing timesheets
+    notifications = []
     for designer, tasks in designers.items():
         # Check if we have a Teams ID for this designer
         if designer in st.session_state.designer_teams_id_mapping:
             designer_teams_id = st.session_state.designer_teams_id_mapping[designer]
-            
-            # Send the notification
-            message_sent = send_designer_notification(
-                designer,
-                designer_teams_id,
-                tasks
-            )
-            
+            notifications.append((designer_teams_id, build_designer_notification_message(tasks)))
+        else:
+            fail_count += 1
+    
+    if notifications:
+        # One messenger for the whole run so the token is acquired once and
+        # the per-designer Graph calls overlap on pooled connections
+        messenger = get_teams_messenger()
+        for message_sent in messenger.notify_users(notifications):
             if message_sent:
                 success_count += 1
             else:
                 fail_count += 1
-        else:
-            fail_count += 1
     
     return True, success_count, fail_count
 
@@ -554,8 +570,7 @@ def get_planning_slots(models, uid, odoo_db, odoo_password, start_date, end_date
                 logger.info(f"Filtered to {len(all_slots)} planning slots for the date range")
                 
             except Exception as e:
-                error_details = traceback.format_exc()
-                logger.error(f"Error with permissive planning slot query: {e}\n{error_details}")
+                logger.exception("Error with permissive planning slot query: %s", e)
         
         # Deduplicate slots by ID
         unique_slots = []
@@ -953,8 +968,7 @@ def load_employee_manager_mapping():
         logger.info(f"Loaded {len(mapping)} employee-manager relationships")
         return mapping
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error loading employee mapping: {e}\n{error_details}")
+        logger.exception("Error loading employee mapping: %s", e)
         return {}
     
 def send_manager_email(manager_name, manager_email, designers_tasks, selected_date):
@@ -966,11 +980,10 @@ def send_manager_email(manager_name, manager_email, designers_tasks, selected_da
         first_name = manager_name.split()[0] if manager_name else "there"
         
         # Determine if any tasks are more than 1 day overdue
-        max_days_overdue = 0
-        for designer_tasks in designers_tasks.values():
-            for task in designer_tasks:
-                days_overdue = task.get("Days Overdue", 0)
-                max_days_overdue = max(max_days_overdue, days_overdue)
+        max_days_overdue = max(
+            (task.get("Days Overdue", 0) for designer_tasks in designers_tasks.values() for task in designer_tasks),
+            default=0
+        )
         
         logger.info(f"Maximum days overdue for any task: {max_days_overdue}")
         
@@ -1007,66 +1020,65 @@ def send_manager_email(manager_name, manager_email, designers_tasks, selected_da
         <ol>
         """
         
-        # Add each designer and their tasks in HTML
-        designer_counter = 1
-        for designer_name, tasks in designers_tasks.items():
-            # Sort tasks by days overdue (descending)
-            sorted_tasks = sorted(tasks, key=lambda x: x.get('Days Overdue', 0), reverse=True)
-            
-            html_body += f"<li><b>{designer_name}</b>\n<ul>\n"
+        # Sort each designer's tasks by days overdue (descending), once for both versions
+        sorted_designers_tasks = [
+            (designer_name, sorted(tasks, key=lambda x: x.get('Days Overdue', 0), reverse=True))
+            for designer_name, tasks in designers_tasks.items()
+        ]
+        
+        # Add each designer and their tasks in HTML (collect parts and join once)
+        html_parts = [html_body]
+        for designer_name, sorted_tasks in sorted_designers_tasks:
+            html_parts.append(f"<li><b>{designer_name}</b>\n<ul>\n")
             
             for task in sorted_tasks:
                 # Add task details
-                html_body += f"<li><b>Project</b>: {task.get('Project', 'Unknown')}</li>\n"
-                html_body += f"<li><b>Task</b>: {task.get('Task', 'Unknown')}</li>\n"
+                html_parts.append(f"<li><b>Project</b>: {task.get('Project', 'Unknown')}</li>\n")
+                html_parts.append(f"<li><b>Task</b>: {task.get('Task', 'Unknown')}</li>\n")
                 
                 if max_days_overdue >= 2:
-                    html_body += f"<li><b>Assignment Dates</b>: {task.get('Date', 'Unknown')}</li>\n"
+                    html_parts.append(f"<li><b>Assignment Dates</b>: {task.get('Date', 'Unknown')}</li>\n")
                 else:
-                    html_body += f"<li><b>Time Assigned</b>: {task.get('Start Time', 'Unknown')}</li>\n"
+                    html_parts.append(f"<li><b>Time Assigned</b>: {task.get('Start Time', 'Unknown')}</li>\n")
                 
-                html_body += f"<li><b>Client Success Contact</b>: {task.get('Client Success Member', 'Unknown')}</li>\n"
+                html_parts.append(f"<li><b>Client Success Contact</b>: {task.get('Client Success Member', 'Unknown')}</li>\n")
             
-            html_body += "</ul></li>\n"
-            designer_counter += 1
+            html_parts.append("</ul></li>\n")
         
         # Add closing in HTML
-        html_body += f"""
+        html_parts.append(f"""
         </ol>
         <p>{closing}</p>
         <p>Thanks,<br>— Operations Team</p>
         </body>
         </html>
-        """
+        """)
+        html_body = "".join(html_parts)
         
         # Create plain text version
-        text_body = f"{greeting}\n\n{intro_text}\n\n"
+        text_parts = [f"{greeting}\n\n{intro_text}\n\n"]
         
         # Add each designer and their tasks
-        designer_counter = 1
-        for designer_name, tasks in designers_tasks.items():
-            # Sort tasks by days overdue (descending)
-            sorted_tasks = sorted(tasks, key=lambda x: x.get('Days Overdue', 0), reverse=True)
-            
-            text_body += f"{designer_counter}. {designer_name}\n"
+        for designer_counter, (designer_name, sorted_tasks) in enumerate(sorted_designers_tasks, start=1):
+            text_parts.append(f"{designer_counter}. {designer_name}\n")
             
             for task in sorted_tasks:
                 # Add task details
-                text_body += f"  • Project: {task.get('Project', 'Unknown')}\n"
-                text_body += f"  • Task: {task.get('Task', 'Unknown')}\n"
+                text_parts.append(f"  • Project: {task.get('Project', 'Unknown')}\n")
+                text_parts.append(f"  • Task: {task.get('Task', 'Unknown')}\n")
                 
                 if max_days_overdue >= 2:
-                    text_body += f"  • Assignment Dates: {task.get('Date', 'Unknown')}\n"
+                    text_parts.append(f"  • Assignment Dates: {task.get('Date', 'Unknown')}\n")
                 else:
-                    text_body += f"  • Time Assigned: {task.get('Start Time', 'Unknown')}\n"
+                    text_parts.append(f"  • Time Assigned: {task.get('Start Time', 'Unknown')}\n")
                 
-                text_body += f"  • Client Success Contact: {task.get('Client Success Member', 'Unknown')}\n"
+                text_parts.append(f"  • Client Success Contact: {task.get('Client Success Member', 'Unknown')}\n")
             
-            text_body += "\n"
-            designer_counter += 1
+            text_parts.append("\n")
         
         # Add closing
-        text_body += f"{closing}\n\nThanks,\n— Operations Team"
+        text_parts.append(f"{closing}\n\nThanks,\n— Operations Team")
+        text_body = "".join(text_parts)
         
         # Attach both versions
         msg.attach(MIMEText(text_body, 'plain'))
@@ -1102,8 +1114,7 @@ def send_manager_email(manager_name, manager_email, designers_tasks, selected_da
             logger.error(f"Unknown error sending email: {e}")
             return False
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error preparing manager email: {e}\n{error_details}")
+        logger.exception("Error preparing manager email: %s", e)
         return False
 
 def send_manager_notifications(designers, selected_date, reference_date=None):
@@ -1191,8 +1202,7 @@ def send_manager_notifications(designers, selected_date, reference_date=None):
         logger.info(f"Manager notification summary: {success_count} successful, {fail_count} failed")
         return True, success_count, fail_count
     except Exception as e:
-        error_details = traceback.format_exc()
-        logger.error(f"Error sending manager notifications: {e}\n{error_details}")
+        logger.exception("Error sending manager notifications: %s", e)
         return False, 0, 0
 
 def normalize_name(name):
@@ -1689,8 +1699,7 @@ def generate_missing_timesheet_report(selected_date, shift_status_filter=None, s
                         st.warning(f"Failed to send emails to {email_fail_count} designers")
                             
                 except Exception as e:
-                    error_details = traceback.format_exc()
-                    logger.error(f"Error sending designer emails: {e}\n{error_details}")
+                    logger.exception("Error sending designer emails: %s", e)
                     st.warning(f"Error sending designer emails: {e}")
             
             # Send Teams webhook notifications if enabled
@@ -1727,19 +1736,24 @@ def generate_missing_timesheet_report(selected_date, shift_status_filter=None, s
                     
                     # Option 2: Production mode - send to individual designers
                     else:
-                        for designer, tasks in designers.items():
-                            # First check if designer has a webhook mapping
-                            if designer in st.session_state.designer_webhook_mapping:
-                                webhook_url = st.session_state.designer_webhook_mapping[designer]
-                                
-                                # Send the webhook notification
-                                webhook_sent = send_teams_webhook_notification(
-                                    designer,
-                                    webhook_url,
-                                    tasks,
-                                    selected_date
-                                )
-                                
+                        # Only designers with a webhook mapping get a notification
+                        webhook_designers = [
+                            designer for designer in designers
+                            if designer in st.session_state.designer_webhook_mapping
+                        ]
+                        
+                        if webhook_designers:
+                            # The webhook posts are independent, so send them concurrently
+                            with ThreadPoolExecutor(max_workers=min(WEBHOOK_MAX_WORKERS, len(webhook_designers))) as executor:
+                                webhook_results = list(executor.map(
+                                    send_teams_webhook_notification,
+                                    webhook_designers,
+                                    [st.session_state.designer_webhook_mapping[designer] for designer in webhook_designers],
+                                    [designers[designer] for designer in webhook_designers],
+                                    itertools.repeat(selected_date)
+                                ))
+                            
+                            for webhook_sent in webhook_results:
                                 if webhook_sent:
                                     webhook_success_count += 1
                                 else:
@@ -1753,8 +1767,7 @@ def generate_missing_timesheet_report(selected_date, shift_status_filter=None, s
                                 st.warning(f"Failed to send Teams webhook notifications to {webhook_fail_count} designers")
                 
                 except Exception as e:
-                    error_details = traceback.format_exc()
-                    logger.error(f"Error sending Teams webhook notifications: {e}\n{error_details}")
+                    logger.exception("Error sending Teams webhook notifications: %s", e)
                     st.warning(f"Error sending Teams webhook notifications: {e}")
             
             # Send Teams direct messages if enabled
@@ -1768,8 +1781,7 @@ def generate_missing_timesheet_report(selected_date, shift_status_filter=None, s
                         if fail_count > 0:
                             st.warning(f"Failed to send Teams direct messages to {fail_count} designers")
                 except Exception as e:
-                    error_details = traceback.format_exc()
-                    logger.error(f"Error sending Teams direct messages: {e}\n{error_details}")
+                    logger.exception("Error sending Teams direct messages: %s", e)
                     st.warning(f"Error sending Teams direct messages: {e}")
             
             # Send manager notifications if enabled
@@ -1787,8 +1799,7 @@ def generate_missing_timesheet_report(selected_date, shift_status_filter=None, s
                         if fail_count > 0:
                             st.warning(f"Failed to send notifications to {fail_count} managers")
                 except Exception as e:
-                    error_details = traceback.format_exc()
-                    logger.error(f"Error sending manager notifications: {e}\n{error_details}")
+                    logger.exception("Error sending manager notifications: %s", e)
                     st.warning(f"Error sending manager notifications: {e}")
             
             return df, missing_count, len(timesheet_entries)
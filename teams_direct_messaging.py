@@ -1,12 +1,98 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import msal
 import time
-import streamlit as st
 import logging
+import threading
+import functools
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+
+# Maximum number of sub-requests Graph accepts in one JSON $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# How many times a $batch resends the sub-requests Graph throttled, and the
+# statuses that mean a sub-request was not acted on and can be resent
+BATCH_RETRY_ATTEMPTS = 3
+BATCH_RETRY_STATUSES = (429, 503)
+
+# Pauses (seconds) between readiness checks on a newly created chat; a new
+# chat is usually readable on the first or second check
+CHAT_READY_DELAYS = (0, 0.25, 0.5, 1.0)
+
+# Application permissions configured on the Azure AD app registration
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+
+# Renew the access token this many seconds before it actually expires
+TOKEN_REFRESH_MARGIN = 300
+
+# (connect, read) timeout in seconds for every Graph call, so a hung
+# connection fails that one notification instead of stalling the run
+GRAPH_TIMEOUT = (5, 30)
+
+# Size of the keep-alive connection pool to graph.microsoft.com; matches the
+# default notify_users worker count so no thread waits for a connection
+GRAPH_POOL_SIZE = 8
+
+class _JitteredRetry(Retry):
+    """Retry whose exponential backoff is spread randomly between 1x and 2x"""
+    
+    def get_backoff_time(self):
+        # Without jitter, notify_users workers throttled together would all
+        # retry in the same instant; Retry-After, when sent, still takes priority
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, backoff)
+
+# Retry throttled (429) and unavailable (503) Graph responses, sleeping for the
+# Retry-After interval Graph sends or a jittered exponential backoff otherwise.
+# Graph has not acted on a request it answers this way, so POSTs are safe to
+# resend; read errors are not retried because the request may already have run.
+GRAPH_RETRY = _JitteredRetry(
+    total=3,
+    read=0,
+    backoff_factor=0.5,
+    status_forcelist=[429, 503],
+    allowed_methods=frozenset(["GET", "POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+# Plain-text body posted into every notification chat
+_MESSAGE_TEMPLATE = (
+    "**TIMESHEET ALERT**\n"
+    "\n"
+    "{message_text}\n"
+    "\n"
+    "**Please log your missing hours in Odoo as soon as possible.**\n"
+    "\n"
+    "If you need assistance, please contact your manager."
+)
+
+# Characters Teams rejects or mangles in a chat topic
+_TOPIC_TRANSLATION = str.maketrans({":": " -", "\n": " "})
+
+# Reminder appended to every notification topic - KEEP THIS REMINDER
+_EMAIL_REMINDER = "- Please check your email for more info"
+
+@functools.lru_cache(maxsize=8)
+def _get_msal_app(client_id, client_secret, tenant_id):
+    """
+    Return the process-wide MSAL application for these credentials.
+
+    Sharing the app keeps its in-memory token cache alive across messenger
+    instances, so a new TeamsMessenger can reuse a token that is still valid.
+    """
+    return msal.ConfidentialClientApplication(
+        client_id=client_id,
+        client_credential=client_secret,
+        authority=f"https://login.microsoftonline.com/{tenant_id}"
+    )
+
 class TeamsMessenger:
     """Teams messenger that creates effective notification chats"""
     
@@ -15,42 +101,60 @@ class TeamsMessenger:
         self.client_secret = client_secret
         self.tenant_id = tenant_id
         self.access_token = None
+        self._token_expires_at = 0
+        self._auth_lock = threading.Lock()
+        
+        # Shared MSAL application (and token cache) for these credentials
+        self.app = _get_msal_app(client_id, client_secret, tenant_id)
         
-        # Create MSAL application
-        self.app = msal.ConfidentialClientApplication(
-            client_id=client_id,
-            client_credential=client_secret,
-            authority=f"https://login.microsoftonline.com/{tenant_id}"
-        )
+        # Reuse TCP/TLS connections to Graph across calls and worker threads
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=GRAPH_POOL_SIZE, max_retries=GRAPH_RETRY))
+    
+    def close(self):
+        """Close the pooled Graph connections"""
+        self.session.close()
     
     def authenticate(self):
         """Get access token using client credentials flow"""
-        try:
-            logger.info("Starting authentication...")
-            result = self.app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-            
-            if "access_token" in result:
-                self.access_token = result["access_token"]
-                logger.info("Successfully authenticated with Microsoft Graph")
+        with self._auth_lock:
+            # Keep using the current token until shortly before it expires
+            if self.access_token and time.time() < self._token_expires_at:
                 return True
-            else:
-                logger.error(f"Failed to authenticate: {result.get('error_description', result)}")
+            
+            try:
+                logger.info("Starting authentication...")
+                # Reuse a still-valid token from MSAL's cache before going to Azure AD
+                result = self.app.acquire_token_silent(GRAPH_SCOPES, account=None)
+                if not result:
+                    result = self.app.acquire_token_for_client(scopes=GRAPH_SCOPES)
+                
+                if "access_token" in result:
+                    self.access_token = result["access_token"]
+                    self._token_expires_at = time.time() + result.get("expires_in", 3600) - TOKEN_REFRESH_MARGIN
+                    # Every Graph call goes through the session, so set the
+                    # bearer header once per token (json= sets Content-Type)
+                    self.session.headers["Authorization"] = f"Bearer {self.access_token}"
+                    logger.info("Successfully authenticated with Microsoft Graph")
+                    return True
+                else:
+                    logger.error("Failed to authenticate: %s", result.get('error_description', result))
+                    return False
+            except Exception as e:
+                logger.error("Authentication exception: %s", e, exc_info=True)
                 return False
-        except Exception as e:
-            logger.error(f"Authentication exception: {str(e)}", exc_info=True)
-            return False
     
     def notify_user(self, user_id, message_text):
         """
         Send notification by creating a chat with a descriptive topic
         """
-        logger.info(f"Starting notification process for user: {user_id}")
+        logger.info("Starting notification process for user: %s", user_id)
         
-        if not self.access_token:
-            logger.info("No access token found, attempting to authenticate...")
-            if not self.authenticate():
-                logger.error("Failed to get access token")
-                return False
+        # Messengers are reused across runs, so always make sure the token is
+        # current; this is a no-op while the token is still valid
+        if not self.authenticate():
+            logger.error("Failed to get access token")
+            return False
                 
         # Step 1: Create the chat first
         chat_id = self._create_notification_chat(user_id, message_text)
@@ -58,79 +162,204 @@ class TeamsMessenger:
             logger.error("Could not create notification chat")
             return False
         
-        # Step 2: Wait a moment for the chat to fully initialize
-        time.sleep(2)
+        # Step 2: Wait for the chat to fully initialize
+        self._wait_for_chat(chat_id)
         
         # Step 3: Try to send a simple text message
         try:
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
-            
-            # Create a simple text message (no HTML formatting)
-            simple_message = f"""
-            **TIMESHEET ALERT**
-            
-            {message_text}
-            
-            **Please log your missing hours in Odoo as soon as possible.**
-            
-            If you need assistance, please contact your manager.
-            """
-            
-            # Prepare the request body
-            message_data = {
-                "body": {
-                    "content": simple_message,
-                    "contentType": "text"  # Use plain text instead of HTML
-                }
-            }
+            message_data = self._build_message_data(message_text)
             
             # Send the message
-            url = f"https://graph.microsoft.com/v1.0/chats/{chat_id}/messages"
-            logger.info(f"Sending message to chat: {chat_id}")
+            url = f"{GRAPH_URL}/chats/{chat_id}/messages"
+            logger.info("Sending message to chat: %s", chat_id)
             
-            response = requests.post(url, headers=headers, json=message_data)
+            response = self.session.post(url, json=message_data, timeout=GRAPH_TIMEOUT)
             
             if response.status_code in [200, 201]:
-                logger.info(f"Message sent successfully to chat: {chat_id}")
+                logger.info("Message sent successfully to chat: %s", chat_id)
                 return True
             else:
-                logger.error(f"Error sending message: {response.status_code} - {response.text}")
+                logger.error("Error sending message: %s - %s", response.status_code, response.text)
                 # Even if the message fails, return True because the chat was created successfully
                 # This ensures the user still gets the notification via the chat name
                 return True
                 
         except Exception as e:
-            logger.error(f"Exception sending message: {str(e)}", exc_info=True)
+            logger.error("Exception sending message: %s", e, exc_info=True)
             # Return True anyway since the chat was created with the notification in the topic
             return True
     
+    def notify_users(self, notifications, max_workers=GRAPH_POOL_SIZE):
+        """
+        Send notifications to several users concurrently.
+
+        Takes a list of (user_id, message_text) pairs and returns a list of
+        results in the same order. The chats are created in parallel, then the
+        follow-up messages go out through Graph JSON batching. As with
+        notify_user, a user counts as notified once their chat exists.
+        """
+        if not notifications:
+            return []
+        
+        if not self.authenticate():
+            logger.error("Failed to get access token")
+            return [False] * len(notifications)
+        
+        workers = min(max_workers, len(notifications))
+        logger.info("Sending %d notifications with %d workers", len(notifications), workers)
+        
+        # Step 1: Create all the chats concurrently and wait for them to initialize
+        user_ids = [user_id for user_id, _ in notifications]
+        message_texts = [message_text for _, message_text in notifications]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chat_ids = list(executor.map(self._create_ready_chat, user_ids, message_texts))
+        
+        messages = [
+            (chat_id, message_text)
+            for chat_id, message_text in zip(chat_ids, message_texts)
+            if chat_id
+        ]
+        if messages:
+            # Step 2: Send the messages, up to GRAPH_BATCH_LIMIT per request
+            self._send_chat_messages(messages)
+        
+        return [bool(chat_id) for chat_id in chat_ids]
+    
+    def _create_ready_chat(self, user_id, message_text):
+        """Create a notification chat and wait until it can take messages"""
+        chat_id = self._create_notification_chat(user_id, message_text)
+        if chat_id:
+            self._wait_for_chat(chat_id)
+        return chat_id
+    
+    def _wait_for_chat(self, chat_id):
+        """
+        Poll a newly created chat until Graph serves it, rather than sleeping
+        a fixed time. Only a 404 means the chat is still propagating; any other
+        error won't clear by waiting, so stop checking. Returns False if the
+        chat is not readable; callers send anyway, as they did after the old
+        fixed wait.
+        """
+        url = f"{GRAPH_URL}/chats/{chat_id}"
+        status = None
+        for delay in CHAT_READY_DELAYS:
+            if delay:
+                time.sleep(delay)
+            try:
+                response = self.session.get(url, timeout=GRAPH_TIMEOUT)
+            except requests.RequestException as e:
+                logger.warning("Exception checking chat %s: %s", chat_id, e)
+                continue
+            
+            status = response.status_code
+            if status == 200:
+                return True
+            if status != 404:
+                logger.warning("Cannot check chat %s: %s - %s", chat_id, status, response.text)
+                return False
+        
+        logger.warning("Chat %s not ready after %d checks (last status: %s)", chat_id, len(CHAT_READY_DELAYS), status)
+        return False
+    
+    def _build_message_data(self, message_text):
+        """Build the plain-text chat message body for a notification"""
+        return {
+            "body": {
+                "content": _MESSAGE_TEMPLATE.format(message_text=message_text),
+                "contentType": "text"  # Use plain text instead of HTML
+            }
+        }
+    
+    def _send_chat_messages(self, messages):
+        """Post (chat_id, message_text) pairs to their chats using Graph $batch"""
+        for start in range(0, len(messages), GRAPH_BATCH_LIMIT):
+            pending = messages[start:start + GRAPH_BATCH_LIMIT]
+            
+            # Throttled sub-requests come back inside a 200 reply, where the
+            # adapter's retry policy can't see them, so resend those here
+            for attempt in range(BATCH_RETRY_ATTEMPTS + 1):
+                if attempt:
+                    logger.info("Resending %d throttled messages in %.1fs", len(pending), retry_after)
+                    time.sleep(retry_after)
+                
+                pending, retry_after = self._send_message_batch(pending, attempt)
+                if not pending:
+                    break
+            else:
+                for chat_id, _ in pending:
+                    logger.error("Giving up on message to chat %s after %d retries", chat_id, BATCH_RETRY_ATTEMPTS)
+    
+    def _send_message_batch(self, chunk, attempt):
+        """
+        Post one $batch of messages. Returns the (chat_id, message_text) pairs
+        Graph throttled and how long to wait before resending them.
+        """
+        batch_data = {
+            "requests": [
+                {
+                    "id": str(index),
+                    "method": "POST",
+                    "url": f"/chats/{chat_id}/messages",
+                    "headers": {"Content-Type": "application/json"},
+                    "body": self._build_message_data(message_text)
+                }
+                for index, (chat_id, message_text) in enumerate(chunk)
+            ]
+        }
+        
+        throttled = []
+        retry_after = 0
+        try:
+            logger.info("Sending batch of %d messages", len(chunk))
+            response = self.session.post(f"{GRAPH_URL}/$batch", json=batch_data, timeout=GRAPH_TIMEOUT)
+            
+            if response.status_code != 200:
+                logger.error("Error sending message batch: %s - %s", response.status_code, response.text)
+                return [], 0
+            
+            # Sub-responses can come back in any order; match them up by id
+            for item in response.json().get("responses", []):
+                chat_id, message_text = chunk[int(item["id"])]
+                status = item.get("status")
+                if status in [200, 201]:
+                    logger.info("Message sent successfully to chat: %s", chat_id)
+                elif status in BATCH_RETRY_STATUSES:
+                    throttled.append((chat_id, message_text))
+                    headers = {key.lower(): value for key, value in (item.get("headers") or {}).items()}
+                    try:
+                        retry_after = max(retry_after, float(headers.get("retry-after", 0)))
+                    except ValueError:
+                        pass
+                else:
+                    logger.error("Error sending message to chat %s: %s - %s", chat_id, status, item.get("body"))
+        except Exception as e:
+            # The chats already carry the notification in their topic
+            logger.error("Exception sending message batch: %s", e, exc_info=True)
+            return [], 0
+        
+        if throttled and not retry_after:
+            # No Retry-After from Graph; fall back to the jittered exponential backoff
+            backoff = GRAPH_RETRY.backoff_factor * (2 ** attempt)
+            retry_after = backoff + random.uniform(0, backoff)
+        
+        return throttled, retry_after
+    
     def _create_notification_chat(self, user_id, message_text):
         """Create a chat with the notification as the topic"""
         try:
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
-            
             # Format message and clean it for topic (remove invalid characters)
-            clean_message = message_text.replace(':', ' -').replace('\n', ' ')
+            clean_message = message_text.translate(_TOPIC_TRANSLATION)
             timestamp = time.strftime('%Y-%m-%d %H-%M')
             
-            # Add email check reminder - KEEP THIS REMINDER
-            email_reminder = "- Please check your email for more info"
-            
             # Create topic that serves as the notification
-            topic = f"{clean_message} {email_reminder} [{timestamp}]"
+            topic = f"{clean_message} {_EMAIL_REMINDER} [{timestamp}]"
             
             # Ensure the topic isn't too long (200 char limit)
             if len(topic) > 200:
                 # Truncate the message part while keeping the email reminder and timestamp
-                max_message_length = 200 - len(email_reminder) - len(timestamp) - 5  # 5 for brackets and spaces
+                max_message_length = 200 - len(_EMAIL_REMINDER) - len(timestamp) - 5  # 5 for brackets and spaces
                 clean_message = clean_message[:max_message_length-3] + "..."
-                topic = f"{clean_message} {email_reminder} [{timestamp}]"
+                topic = f"{clean_message} {_EMAIL_REMINDER} [{timestamp}]"
             
             # Create chat with notification in topic
             chat_data = {
@@ -140,23 +369,23 @@ class TeamsMessenger:
                     {
                         "@odata.type": "#microsoft.graph.aadUserConversationMember",
                         "roles": ["owner"],
-                        "user@odata.bind": f"https://graph.microsoft.com/v1.0/users/{user_id}"
+                        "user@odata.bind": f"{GRAPH_URL}/users/{user_id}"
                     }
                 ]
             }
             
-            url = "https://graph.microsoft.com/v1.0/chats"
-            logger.info(f"Creating notification chat with topic: {topic}")
+            url = f"{GRAPH_URL}/chats"
+            logger.info("Creating notification chat with topic: %s", topic)
             
-            response = requests.post(url, headers=headers, json=chat_data)
+            response = self.session.post(url, json=chat_data, timeout=GRAPH_TIMEOUT)
             
             if response.status_code in [200, 201]:
                 chat_id = response.json().get("id")
-                logger.info(f"Created notification chat: {chat_id}")
+                logger.info("Created notification chat: %s", chat_id)
                 return chat_id
             else:
-                logger.error(f"Error creating chat: {response.status_code} - {response.text}")
+                logger.error("Error creating chat: %s - %s", response.status_code, response.text)
                 return None
         except Exception as e:
-            logger.error(f"Exception creating chat: {str(e)}", exc_info=True)
+            logger.error("Exception creating chat: %s", e, exc_info=True)
             return None
\ No newline at end of file